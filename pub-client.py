@@ -1,5 +1,4 @@
 import datetime
-import json
 import paho.mqtt.client as mqtt
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
@@ -10,6 +9,7 @@ from typing import Dict, Any, List
 import os
 import yaml
 import threading
+from dataclasses import dataclass, field
 
 # from RepeatedTimer import RepeatedTimer
 from util import (
@@ -20,14 +20,26 @@ from util import (
     connect_to_broker,
     transport,
     parse_yaml,
+    write_json,
+    ClientState,
+    BATCHED_PAYLOAD_STRUCT,
 )
 
 send_interval = 1.0
 
 
+@dataclass(slots=True)
+class PubState(ClientState):
+    connected: bool = False
+    data: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    curr_seq_num: int = 1
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    published_count: int = 0
+
+
 def on_connect(
     client: mqtt.Client,
-    userdata: Dict[str, Any],
+    userdata: PubState,
     flags: Dict[str, Any],
     reason: ReasonCodes,
     properties: Properties,
@@ -37,18 +49,19 @@ def on_connect(
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    userdata["connected"] = True
+    userdata.connected = True
 
 
-def on_publish(client: mqtt.Client, userdata: Dict[str, Any], mid: int):
+def on_publish(client: mqtt.Client, userdata: PubState, mid: int):
     """QoS 0: called when message has left the publisher
     QoS 1 & 2: called when handshakes have completed"""
     p_time = get_time()
 
-    userdata["lock"].acquire()
-    if userdata["data"].get(mid, None) is None:
+    userdata.lock.acquire()
+    pkt = userdata.data.get(mid, None)
+    if pkt is None:
         # publishing interval not over yet
-        userdata["data"][mid] = {
+        userdata.data[mid] = {
             "publishing_time": -1,
             "published_time": p_time,
             "time_diff": -1,
@@ -57,28 +70,32 @@ def on_publish(client: mqtt.Client, userdata: Dict[str, Any], mid: int):
         }
     else:
         # publishing interval over
-        userdata["data"][mid]["published_time"] = p_time
-        userdata["data"][mid]["time_diff"] = (
-            p_time - userdata["data"][mid]["publishing_time"]
-        )
-    userdata["lock"].release()
+        pkt["published_time"] = p_time
+        pkt["time_diff"] = p_time - pkt["publishing_time"]
+    userdata.lock.release()
 
-    userdata["published_count"] += 1
+    userdata.published_count += 1
 
-    # userdata["curr_seq_num"] += 1
+    # userdata.curr_seq_num += 1
 
 
-def on_log(client: mqtt.Client, userdata: Dict[str, Any], level: int, buf: str):
+def on_log(client: mqtt.Client, userdata: PubState, level: int, buf: str):
     print(f"[{level}] {buf}")
 
 
+def make_payload(userdata: PubState, seq_num: int, cur_time: float):
+    if userdata.payload_format == "batched":
+        return BATCHED_PAYLOAD_STRUCT.pack(seq_num, cur_time)
+    return f"{seq_num} {cur_time}"
+
+
 def send_packets(userdata):
-    while userdata["curr_seq_num"] <= userdata["total_packets"]:
+    while userdata.curr_seq_num <= userdata.total_packets:
         cur_time: float = get_time()
-        seq_num = userdata["curr_seq_num"]
+        seq_num = userdata.curr_seq_num
 
         msg: mqtt.MQTTMessageInfo = client.publish(
-            "test", f"{seq_num} {cur_time}", userdata["qos"]
+            "test", make_payload(userdata, seq_num, cur_time), userdata.qos
         )
 
         # print(msg.rc)
@@ -88,27 +105,30 @@ def send_packets(userdata):
             print("Retrying...")
 
             cur_time = get_time()
-            msg = client.publish("test", f"{seq_num} {cur_time}", userdata["qos"])
+            msg = client.publish(
+                "test", make_payload(userdata, seq_num, cur_time), userdata.qos
+            )
 
-        userdata["lock"].acquire()
-        if data.get(msg.mid, None) is None:
+        userdata.lock.acquire()
+        pkt = data.get(msg.mid, None)
+        if pkt is None:
             # on_publish() not called yet
             data[msg.mid] = {
                 "publishing_time": cur_time,
                 "published_time": -1,
                 "time_diff": -1,
                 "seq_num": seq_num,
-                "qos": userdata["qos"],
+                "qos": userdata.qos,
             }
         else:
             # on_publish() already called
-            data[msg.mid]["publishing_time"] = cur_time
-            data[msg.mid]["seq_num"] = seq_num
-            data[msg.mid]["qos"] = userdata["qos"]
-            data[msg.mid]["time_diff"] = data[msg.mid]["published_time"] - cur_time
-        userdata["lock"].release()
+            pkt["publishing_time"] = cur_time
+            pkt["seq_num"] = seq_num
+            pkt["qos"] = userdata.qos
+            pkt["time_diff"] = pkt["published_time"] - cur_time
+        userdata.lock.release()
         print(f"Message {msg.mid} with seq num {seq_num} is published")
-        userdata["curr_seq_num"] += 1
+        userdata.curr_seq_num += 1
         time.sleep(1)
 
 
@@ -129,24 +149,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # initialise data
-    data: Dict[int, Dict[str, Any]] = {}
-    conn_data: List[Dict[str, Any]] = []
-
-    userdata: Dict[str, Any] = {
-        "connected": False,
-        "data": data,
-        "total_packets": 50,
-        "qos": 0,
-        "tls": False,
-        "label": "normal",
-        "curr_seq_num": 1,
-        "lock": threading.Lock(),
-        "published_count": 0,
-        "conn_time": -1,
-        "conn_tries": 0,
-        "conn_data": conn_data,
-    }
-    sent: List[bool] = [False] * userdata["total_packets"]
+    userdata = PubState()
+    data: Dict[int, Dict[str, Any]] = userdata.data
+    conn_data: List[Dict[str, Any]] = userdata.conn_data
+    sent: List[bool] = [False] * userdata.total_packets
 
     userdata = parse_yaml(args.file, userdata, "publisher")
     print(f"userdata: {userdata}")
@@ -158,7 +164,7 @@ if __name__ == "__main__":
         transport=transport,
     )
     client.username_pw_set("test", "test")
-    if userdata["tls"]:
+    if userdata.tls:
         client.tls_set()
 
     client.on_connect = on_connect
@@ -168,19 +174,19 @@ if __name__ == "__main__":
     # connect to host
     properties = Properties(PacketTypes.CONNECT)
     properties.SessionExpiryInterval = 30
-    connect_to_broker(client, userdata, properties)
+    connect_to_broker(client, userdata, properties=properties)
 
     start_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     # start looping to read from and write to broker
     client.loop_start()
 
     # wait for connection to be established before publishing
-    while not userdata["connected"]:
+    while not userdata.connected:
         pass
 
     send_packets(userdata)
 
-    while userdata["published_count"] < userdata["total_packets"]:
+    while userdata.published_count < userdata.total_packets:
         time.sleep(1)
 
     cur_date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -197,28 +203,27 @@ if __name__ == "__main__":
         stats_fname = (
             stats_folder 
             + "_qos" 
-            + str(userdata["qos"])
-            + "_" + userdata['label']
-            + ("_tls" if userdata["tls"] else "") 
+            + str(userdata.qos)
+            + "_" + userdata.label
+            + ("_tls" if userdata.tls else "") 
             + ".json"
             )
 
         if not os.path.isdir(stats_folder):
             os.mkdir(stats_folder)
 
-        with open(stats_fname, "w") as stats_f:
-            summary_data = {
-                "start_time": start_time,
-                "label": userdata["label"],
-                "pub_data_file": data_fname,
-                "tls": userdata["tls"],
-                "qos": userdata["qos"],
-                "pkt_sent": userdata["total_packets"],
-                "pub_delay": pub_delay_stats,
-            }
-            if conn_data:
-                summary_data["conn_delay"] = conn_delay_stats
-                summary_data["conn_tries"] = conn_tries_stats
-                summary_data["conn_data_file"] = conn_data_fname
+        summary_data = {
+            "start_time": start_time,
+            "label": userdata.label,
+            "pub_data_file": data_fname,
+            "tls": userdata.tls,
+            "qos": userdata.qos,
+            "pkt_sent": userdata.total_packets,
+            "pub_delay": pub_delay_stats,
+        }
+        if conn_data:
+            summary_data["conn_delay"] = conn_delay_stats
+            summary_data["conn_tries"] = conn_tries_stats
+            summary_data["conn_data_file"] = conn_data_fname
 
-            json.dump({"publisher": summary_data}, stats_f)
+        write_json(stats_fname, {"publisher": summary_data})
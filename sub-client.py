@@ -5,98 +5,294 @@ from paho.mqtt.properties import Properties
 from paho.mqtt.reasoncodes import ReasonCodes
 import time
 import datetime
-import socket
 import argparse
 import random
 import threading
+import logging
 import os
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Tuple
+from dataclasses import dataclass, field
+
+import numpy as np
 
 from util import (
     dump_data,
     calc_stats,
+    calc_array_stats,
     get_time,
     record_connect,
     connect_to_broker,
     transport,
     parse_yaml,
+    write_json,
+    ClientState,
+    input_field,
+    RunningStats,
+    BATCHED_PAYLOAD_STRUCT,
+    BATCHED_PAYLOAD_DTYPE,
+    RECONNECT_MIN_DELAY,
+    RECONNECT_MAX_DELAY,
 )
 
+logger = logging.getLogger("sub")
+
+# Order of fields matches the tuples buffered in userdata.e2e_batch
+E2E_FIELDS: Dict[str, Any] = {
+    "seq_num": np.int64,
+    "send_time": np.float64,
+    "rcv_time": np.float64,
+    "time_diff": np.float64,
+    "qos": np.int8,
+}
+E2E_BATCH_SIZE = 256
+
+
+@dataclass(slots=True)
+class SubState(ClientState):
+    disconnect_perc: float = input_field(0)
+    disconnect_interval: float = input_field(10)
+    disconnect_duration: float = input_field(10)
+    # False: only keep running statistics instead of every packet (no e2e data file is written)
+    keep_samples: bool = input_field(True)
+    # Allocated once total_packets is known
+    e2e_arrays: Optional[Dict[str, np.ndarray]] = field(default=None, repr=False)
+    e2e_idx: int = 0
+    # (seq_num, send_time, rcv_time, time_diff, qos) tuples not yet copied into e2e_arrays
+    e2e_batch: List[Optional[Tuple]] = field(
+        default_factory=lambda: [None] * E2E_BATCH_SIZE, repr=False
+    )
+    e2e_batch_idx: int = 0
+    last_seq_num: int = -1
+    # Only used when keep_samples is False
+    e2e_stats: RunningStats = field(default_factory=RunningStats)
+    disconnect_data: List[Dict[str, Any]] = field(default_factory=list)
+    stop_flag: bool = False
+    # Set by on_connect so that the disconnect thread knows the reconnect has completed
+    reconnected: threading.Event = field(default_factory=threading.Event)
+    disconnect_thread: Optional[threading.Thread] = None
+
+
+def sleep_unless_stopped(
+    userdata: SubState, duration: float, until: Optional[threading.Event] = None
+) -> bool:
+    """Sleeps for duration seconds in short steps so that setting stop_flag ends the sleep early.
+    If until is given, also returns as soon as it is set. Returns True if stop_flag was set."""
+    deadline: float = time.monotonic() + duration
+    while not userdata.stop_flag:
+        remaining: float = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if until is None:
+            time.sleep(min(1.0, remaining))
+        elif until.wait(min(1.0, remaining)):
+            return False
+    return True
+
 
-def periodic_disconnect(client: mqtt.Client, userdata: Dict[str, Any]):
+def periodic_disconnect(client: mqtt.Client, userdata: SubState):
     """Periodically disconnects the client based on the specified disconnect_perc. Ends on KeyboardInterrupt."""
-    while not userdata["disconnect_event"].is_set():
-        time.sleep(userdata["disconnect_interval"])
-        n: float = random.uniform(0, 1)
-        if n <= userdata["disconnect_perc"]:
+    # Bind values that do not change to locals once instead of looking them up every iteration
+    #   stop_flag and last_seq_num are updated by other threads so they are still read from userdata
+    interval: float = userdata.disconnect_interval
+    perc: float = userdata.disconnect_perc
+    duration: float = userdata.disconnect_duration
+    disconnect_data: List[Dict[str, Any]] = userdata.disconnect_data
+    rand = random.random
+    while not userdata.stop_flag:
+        if sleep_unless_stopped(userdata, interval):
+            break
+        if rand() <= perc:
             client.disconnect()
-            userdata["e2e_data"].append(
+            disconnect_data.append(
                 {
                     "seq_num": -1,
-                    "last_seq_num": userdata["e2e_data"][-1]["seq_num"]
-                    if len(userdata["e2e_data"]) > 0
-                    else -1,
+                    "last_seq_num": userdata.last_seq_num,
                     "disconnect_time": get_time(),
                     "reconnect_time": -1,
                 }
             )
-            # wait for reconnect before starting next interval
-            time.sleep(userdata["disconnect_duration"])
+            # paho's network thread exits after a client-initiated disconnect
+            client.loop_stop()
+            # stay disconnected for disconnect_duration, then reconnect before starting next interval
+            if sleep_unless_stopped(userdata, duration):
+                break
+            userdata.reconnected.clear()
+            reconnect_to_broker(client, userdata)
+            # main thread may already have stopped the network thread for shutdown
+            if userdata.stop_flag:
+                break
+            client.loop_start()
+            # start next interval once on_connect confirms the reconnect instead of assuming it is done
+            sleep_unless_stopped(userdata, duration * 2, until=userdata.reconnected)
+
+
+def reconnect_to_broker(client: mqtt.Client, userdata: SubState):
+    """Retries reconnecting until it succeeds or stop_flag is set, recording the reconnect time"""
+    connected = False
+    backoff: float = RECONNECT_MIN_DELAY
+    userdata.conn_time = get_time()
+    while not connected and not userdata.stop_flag:
+        userdata.conn_tries += 1
+        try:
+            client.reconnect()
+            connected = True
+            userdata.disconnect_data[-1]["reconnect_time"] = get_time()
+        # OSError also covers socket.timeout, refused connections and DNS/network errors,
+        #   any of which would otherwise end the disconnect thread with the network thread stopped
+        except (OSError, mqtt.WebsocketConnectionError) as e:
+            print(f"reconnect error ({e!r}), retrying in {backoff}s...")
+            sleep_unless_stopped(userdata, backoff)
+            backoff = min(RECONNECT_MAX_DELAY, backoff * 2)
+
+
+def init_e2e_arrays(size: int) -> Dict[str, np.ndarray]:
+    """Preallocates one array per e2e field so that packets are stored as a structure of arrays"""
+    return {key: np.empty(size, dtype=dtype) for key, dtype in E2E_FIELDS.items()}
+
+
+def grow_e2e_arrays(arrays: Dict[str, np.ndarray]):
+    """Doubles the capacity of the e2e arrays, eg. when duplicates push us past total_packets"""
+    for key, arr in arrays.items():
+        arrays[key] = np.resize(arr, max(2 * len(arr), 1))
+
+
+def flush_e2e_batch(userdata: SubState):
+    """Copies the packets buffered in e2e_batch into the e2e arrays and empties the batch"""
+    count: int = userdata.e2e_batch_idx
+    if count == 0:
+        return
+    i: int = userdata.e2e_idx
+    arrays: Dict[str, np.ndarray] = userdata.e2e_arrays
+    while i + count > len(arrays["seq_num"]):
+        grow_e2e_arrays(arrays)
+    columns = zip(*userdata.e2e_batch[:count])
+    for arr, column in zip(arrays.values(), columns):
+        arr[i : i + count] = column
+    userdata.e2e_idx = i + count
+    userdata.e2e_batch_idx = 0
+
+
+def store_e2e_records(
+    userdata: SubState, records: np.ndarray, rcv_time: float, qos: int
+):
+    """Copies (seq_num, send_time) records received in one message into the e2e arrays"""
+    count: int = len(records)
+    if count == 0:
+        return
+    userdata.last_seq_num = int(records["seq_num"][-1])
+    if not userdata.keep_samples:
+        for time_diff in (rcv_time - records["send_time"]).tolist():
+            userdata.e2e_stats.update(time_diff)
+        return
+    # keep packets in arrival order
+    flush_e2e_batch(userdata)
+    i: int = userdata.e2e_idx
+    arrays: Dict[str, np.ndarray] = userdata.e2e_arrays
+    while i + count > len(arrays["seq_num"]):
+        grow_e2e_arrays(arrays)
+    arrays["seq_num"][i : i + count] = records["seq_num"]
+    arrays["send_time"][i : i + count] = records["send_time"]
+    arrays["rcv_time"][i : i + count] = rcv_time
+    arrays["time_diff"][i : i + count] = rcv_time - records["send_time"]
+    arrays["qos"][i : i + count] = qos
+    userdata.e2e_idx = i + count
+
+
+def e2e_records(arrays: Dict[str, np.ndarray], count: int) -> List[Dict[str, Any]]:
+    """Converts the first count entries of the e2e arrays into a list of per-packet dicts"""
+    keys = list(arrays)
+    columns = [arrays[key][:count].tolist() for key in keys]
+    return [dict(zip(keys, row)) for row in zip(*columns)]
 
 
 def on_connect(
     client: mqtt.Client,
-    userdata: Dict[str, Any],
+    userdata: SubState,
     flags: Dict[str, Any],
     reason: ReasonCodes,
     properties: Properties,
 ):
     """Callback for when client receives a CONNACK response from broker"""
     record_connect(userdata)
+    userdata.reconnected.set()
     print("Connected with reason code " + reason.getName())
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe("test", qos=userdata["qos"])
+    client.subscribe("test", qos=userdata.qos)
 
     # Create and start disconnect thread only if:
     #   We want disconnections to happen (ie. disconnect_perc > 0)
     #   Thread has not already been created and started
-    if userdata["disconnect_thread"] is None and userdata["disconnect_perc"] > 0:
-        userdata["disconnect_event"] = threading.Event()
-        userdata["disconnect_thread"] = threading.Thread(
+    if userdata.disconnect_thread is None and userdata.disconnect_perc > 0:
+        userdata.disconnect_thread = threading.Thread(
             target=periodic_disconnect, args=[client, userdata]
         )
-        userdata["disconnect_thread"].start()
+        userdata.disconnect_thread.start()
 
 
-def on_message(client: mqtt.Client, userdata: Dict[str, Any], msg: mqtt.MQTTMessage):
+def on_message(client: mqtt.Client, userdata: SubState, msg: mqtt.MQTTMessage):
     """Callback for when a PUBLISH message is received from the server"""
     rcv_time: float = get_time()
-    print(f"{msg.topic} {msg.payload} {msg.mid}")
-    if msg.topic == "test":
-        content: str = msg.payload.decode()
-        seq_num, send_time = content.split(" ")
-        pkt_data: Dict[str, Any] = {
-            "seq_num": int(seq_num),
-            "send_time": float(send_time),
-            "rcv_time": rcv_time,
-            "time_diff": (rcv_time - float(send_time)),
-            "qos": msg.qos,
-        }
-        userdata["e2e_data"].append(pkt_data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s %s %s", msg.topic, msg.payload, msg.mid)
+    if msg.topic != "test":
+        return
+    if userdata.payload_format == "batched":
+        payload: bytes = msg.payload
+        if len(payload) == 0 or len(payload) % BATCHED_PAYLOAD_DTYPE.itemsize:
+            # Raising here would stop paho's network thread, so drop the message instead
+            logger.warning(
+                "Dropping message %s: %d bytes is not a whole number of batched records, "
+                "check that publisher and subscriber use the same payload_format",
+                msg.mid,
+                len(payload),
+            )
+            return
+        if len(payload) != BATCHED_PAYLOAD_STRUCT.size:
+            # Parse all packed records at once and copy them straight into the e2e arrays
+            records: np.ndarray = np.frombuffer(payload, dtype=BATCHED_PAYLOAD_DTYPE)
+            store_e2e_records(userdata, records, rcv_time, msg.qos)
+            return
+        # Single record, handled like a text payload since NumPy overhead outweighs the parse
+        seq_num, send_time = BATCHED_PAYLOAD_STRUCT.unpack(payload)
+    else:
+        try:
+            seq_num_b, send_time_b = msg.payload.split(b" ", 1)
+            seq_num = int(seq_num_b)
+            send_time = float(send_time_b)
+        except ValueError:
+            logger.warning(
+                "Dropping message %s: not a text payload, "
+                "check that publisher and subscriber use the same payload_format",
+                msg.mid,
+            )
+            return
+
+    time_diff: float = rcv_time - send_time
+    userdata.last_seq_num = seq_num
+    if not userdata.keep_samples:
+        userdata.e2e_stats.update(time_diff)
+        return
+
+    # Buffer packet and only copy into the e2e arrays once the batch is full
+    b: int = userdata.e2e_batch_idx
+    userdata.e2e_batch[b] = (seq_num, send_time, rcv_time, time_diff, msg.qos)
+    userdata.e2e_batch_idx = b + 1
+    if b + 1 == E2E_BATCH_SIZE:
+        flush_e2e_batch(userdata)
 
 
 def on_log(client, userdata, level, buf):
     """Logs messages sent and received by client"""
-    print(f"[{level}] {buf}")
+    logger.debug("[%s] %s", level, buf)
 
 
 if __name__ == "__main__":
     # Process arguments
     parser = argparse.ArgumentParser(
         prog="sub-client",
-        usage="Usage: python sub-client.py -f <input-file-path>",
+        usage="Usage: python sub-client.py -f <input-file-path> [-v]",
     )
 
     parser.add_argument(
@@ -106,28 +302,25 @@ if __name__ == "__main__":
         required=False,
         default="",
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Log every received message and paho's client logs",
+        action="store_true",
+    )
     args = parser.parse_args()
+    logging.basicConfig(
+        format="%(message)s", level=logging.DEBUG if args.verbose else logging.INFO
+    )
 
     # Initialise userdata to be passed to client callbacks
-    e2e_data: List[Dict[str, Any]] = []
-    conn_data: List[Dict[str, Any]] = []
-    userdata: Dict[str, Any] = {  # default values
-        "qos": 0,
-        "label": "normal",
-        "tls": False,
-        "total_packets": 50,
-        "e2e_data": e2e_data,
-        "conn_time": -1,
-        "conn_tries": 0,
-        "conn_data": conn_data,
-        "disconnect_perc": 0,
-        "disconnect_interval": 10,
-        "disconnect_duration": 10,
-        "disconnect_event": None,  # Optional[threading.Event]
-        "disconnect_thread": None,  # Optional[threading.Thread]
-    }
+    userdata = SubState()
+    disconnect_data: List[Dict[str, Any]] = userdata.disconnect_data
+    conn_data: List[Dict[str, Any]] = userdata.conn_data
     userdata = parse_yaml(args.file, userdata, "subscriber")
     print(f"userdata: {userdata}")
+    if userdata.keep_samples:
+        userdata.e2e_arrays = init_e2e_arrays(userdata.total_packets)
 
     try:
         # Initialise client and callbacks
@@ -138,102 +331,116 @@ if __name__ == "__main__":
             transport=transport,
         )
         client.username_pw_set("test", "test")
-        if userdata["tls"]:
+        if userdata.tls:
             client.tls_set()
 
         client.on_connect = on_connect
         client.on_message = on_message
-        client.on_log = on_log
+        if args.verbose:
+            client.on_log = on_log
 
         # Initial connect
+        #   properties are built once here, client.reconnect() reuses the ones passed to connect()
         properties = Properties(PacketTypes.CONNECT)
         properties.SessionExpiryInterval = 30
-        connect_to_broker(client, userdata, properties)
+        connect_to_broker(client, userdata, properties=properties)
 
         start_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        # Loop forever with periodic disconnects and reconnects
+        # Network traffic is handled by paho's network thread, periodic disconnects and
+        # reconnects by the disconnect thread. Main thread only waits for shutdown.
+        client.loop_start()
+        # sleep in short steps so that ctrl-c is also delivered on Windows
         while True:
-            client.loop_forever()
-            # client disconnects and loop stops --> initiate reconnect after disconnect_duration
-            time.sleep(userdata["disconnect_duration"])
-            connected = False
-            userdata["conn_time"] = get_time()
-            while not connected:
-                userdata["conn_tries"] += 1
-                try:
-                    client.reconnect()
-                    connected = True
-                    userdata["e2e_data"][-1]["reconnect_time"] = get_time()
-                except socket.timeout:
-                    pass
+            time.sleep(1)
     except KeyboardInterrupt:
+        # Stop disconnect thread, blocks until disconnect thread has been stopped
+        if userdata.disconnect_thread is not None:
+            print("Cancelling timer...")
+            userdata.stop_flag = True
+            #   bounded since the disconnect thread checks stop_flag at least every second
+            userdata.disconnect_thread.join()
+        # Stop network thread so that no more messages are received while processing data
+        client.loop_stop()
+
         cur_date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         if conn_data:
             conn_data_fname = dump_data("sub-conn", conn_data, cur_date, userdata)
             conn_delay_stats = calc_stats(conn_data)
             conn_tries_stats = calc_stats(conn_data, "tries")
-        if e2e_data:
-            # Write collected data to file
-            #   Can delete if we don't need to collect all the generated data
-            #   Just collecting for now in case we want to do further analysis later on
-            data_fname = dump_data("sub", e2e_data, cur_date, userdata)
+        if disconnect_data:
+            dump_data("sub-disconnect", disconnect_data, cur_date, userdata)
+        if userdata.keep_samples:
+            flush_e2e_batch(userdata)
+        pkt_recv = (
+            userdata.e2e_idx if userdata.keep_samples else userdata.e2e_stats.count
+        )
+        if pkt_recv:
+            data_fname = None
+            if userdata.keep_samples:
+                e2e_data = e2e_records(userdata.e2e_arrays, userdata.e2e_idx)
+
+                # Write collected data to file
+                #   Can delete if we don't need to collect all the generated data
+                #   Just collecting for now in case we want to do further analysis later on
+                data_fname = dump_data("sub", e2e_data, cur_date, userdata)
 
             # Process collected data
             print("Calculating statistics...")
-            e2e_stats = calc_stats(e2e_data)
+            if userdata.keep_samples:
+                arrays = userdata.e2e_arrays
+                count = userdata.e2e_idx
+                e2e_stats = calc_array_stats(
+                    arrays["time_diff"][:count][arrays["seq_num"][:count] != -1]
+                )
+            else:
+                # Kept up to date in on_message, median is approximate
+                e2e_stats = userdata.e2e_stats.as_dict()
 
             stats_folder = "summary/"
             stats_fname = (
                 stats_folder
                 + "_qos"
-                + str(userdata["qos"])
+                + str(userdata.qos)
                 + "_"
-                + userdata["label"]
-                + ("_tls" if userdata["tls"] else "")
+                + userdata.label
+                + ("_tls" if userdata.tls else "")
                 + ".json"
             )
 
             if not os.path.isdir(stats_folder):
                 os.mkdir(stats_folder)
 
-            with open(stats_fname, "r+") as stats_f:
+            with open(stats_fname, "r") as stats_f:
                 cur_data = json.load(stats_f)
-                summary_data = {
-                    "start_time": start_time,
-                    "label": userdata["label"],
-                    "e2e_data_file": data_fname,
-                    "tls": userdata["tls"],
-                    "qos": userdata["qos"],
-                    "pkt_sent": userdata["total_packets"],
-                    "pkt_recv": e2e_stats["count"],
-                    "pkt_loss": (userdata["total_packets"] - e2e_stats["count"])
-                    / userdata["total_packets"],
-                    "e2e_delay": e2e_stats,
-                }
-                if conn_data:
-                    summary_data["conn_delay"] = conn_delay_stats
-                    summary_data["conn_tries"] = conn_tries_stats
-                    summary_data["conn_data_file"] = conn_data_fname
+            summary_data = {
+                "start_time": start_time,
+                "label": userdata.label,
+                "e2e_data_file": data_fname,
+                "tls": userdata.tls,
+                "qos": userdata.qos,
+                "pkt_sent": userdata.total_packets,
+                "pkt_recv": e2e_stats["count"],
+                "pkt_loss": (userdata.total_packets - e2e_stats["count"])
+                / userdata.total_packets,
+                "e2e_delay": e2e_stats,
+            }
+            if conn_data:
+                summary_data["conn_delay"] = conn_delay_stats
+                summary_data["conn_tries"] = conn_tries_stats
+                summary_data["conn_data_file"] = conn_data_fname
 
-                stats_f.seek(0)
-                json.dump({**cur_data, "subscriber": summary_data}, stats_f)
+            write_json(stats_fname, {**cur_data, "subscriber": summary_data})
 
             os.rename(
                 stats_fname,
                 stats_folder
                 + cur_date
                 + "_qos"
-                + str(userdata["qos"])
+                + str(userdata.qos)
                 + "_"
-                + userdata["label"]
-                + ("_tls" if userdata["tls"] else "")
+                + userdata.label
+                + ("_tls" if userdata.tls else "")
                 + ".json",
             )
 
-        # Stop disconnect thread, blocks until disconnect thread has been stopped
-        if userdata["disconnect_thread"] is not None:
-            print("Cancelling timer...")
-            userdata["disconnect_event"].set()
-            userdata["disconnect_thread"].join()
-
         print("Subscriber closed successfully")
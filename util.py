@@ -1,11 +1,24 @@
 import os
-import json
-import statistics
+import math
+import bisect
+import io
 import time
+import pickle
+import tempfile
 import yaml
+import numpy as np
+import orjson
 import socket
+import struct
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, List
 import paho.mqtt.client as mqtt
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 hostname = "m.shohamc1.com"
 port = 80
@@ -14,6 +27,70 @@ transport = "websockets"
 # port = 1883
 # transport = "tcp"
 keepalive = 60
+# seconds, for retrying failed connection attempts
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+DUMP_BUFFER_SIZE = 64 * 1024
+NS_PER_US = 1_000
+US_PER_MS = 1_000
+
+# desired marker position increments for the P-square median estimate
+P2_MEDIAN_INCREMENTS = (0.0, 0.25, 0.5, 0.75, 1.0)
+
+# payload_format "batched": each message is one or more packed (seq_num, send_time) records
+BATCHED_PAYLOAD_STRUCT = struct.Struct("<qd")
+BATCHED_PAYLOAD_DTYPE = np.dtype([("seq_num", "<i8"), ("send_time", "<f8")])
+
+
+def input_field(default):
+    """Dataclass field that may be set from the input file"""
+    return field(default=default, metadata={"input": True})
+
+
+@dataclass(slots=True)
+class ClientState:
+    """State shared by both clients, passed to client callbacks as userdata"""
+
+    qos: int = input_field(0)
+    label: str = input_field("normal")
+    tls: bool = input_field(False)
+    total_packets: int = input_field(50)
+    payload_format: str = input_field("text")  # text, batched
+    conn_time: float = -1
+    conn_tries: int = 0
+    conn_data: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def load_yaml(fname):
+    # Parsed input file is cached as a pickle next to it, reused while newer than the yaml file
+    cache_fname = fname + ".pkl"
+    if (
+        os.path.exists(cache_fname)
+        and os.path.getmtime(cache_fname) > os.path.getmtime(fname)
+    ):
+        try:
+            with open(cache_fname, "rb") as cache_f:
+                return pickle.load(cache_f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass  # unreadable or truncated cache, parse the yaml file again
+    with open(fname, "r") as input_f:
+        input_values = yaml.load(input_f, Loader=SafeLoader)
+    # Write to a temporary file first so that an interrupted or concurrent write
+    # never leaves a partial cache in place
+    try:
+        fd, tmp_fname = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fname)), suffix=".pkl.tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as cache_f:
+                pickle.dump(input_values, cache_f)
+            os.replace(tmp_fname, cache_fname)
+        except BaseException:
+            os.remove(tmp_fname)
+            raise
+    except OSError:
+        pass
+    return input_values
 
 
 def parse_yaml(fname, userdata, caller):
@@ -21,14 +98,17 @@ def parse_yaml(fname, userdata, caller):
         if not os.path.exists(fname):
             print(f"{fname} is not a valid path. Using default values.")
         else:
-            with open(fname, "r") as input_f:
-                input_values = yaml.safe_load(input_f)
-                if input_values.get(caller, None) is not None:
-                    userdata = {**userdata, **input_values[caller]}
-                if input_values.get("shared", None) is not None:
-                    userdata = {**userdata, **input_values["shared"]}
+            input_values = load_yaml(fname)
+            # Only input variables may be set, not runtime state such as data or locks
+            input_keys = {f.name for f in fields(userdata) if f.metadata.get("input")}
+            for section in (caller, "shared"):
+                for key, value in (input_values.get(section, None) or {}).items():
+                    if key in input_keys:
+                        setattr(userdata, key, value)
+                    else:
+                        print(f"Unknown input variable {key}, ignoring.")
     global port
-    if userdata["tls"]:
+    if userdata.tls:
         port = 443
     return userdata
 
@@ -39,55 +119,139 @@ def dump_data(subfolder, data_dump, cur_date, userdata):
         data_folder
         + cur_date
         + "_qos"
-        + str(userdata["qos"])
+        + str(userdata.qos)
         + "_"
-        + userdata["label"]
-        + ("_tls" if userdata["tls"] else "")
+        + userdata.label
+        + ("_tls" if userdata.tls else "")
         + ".json"
     )
     if not os.path.isdir(data_folder):
         os.makedirs(data_folder)
-    with open(data_fname, "w") as data_f:
-        json.dump(data_dump, data_f)
+    write_json(data_fname, data_dump)
     return data_fname
 
 
+def write_json(fname, data):
+    # serialise in one shot and write through a single large buffer
+    with open(fname, "wb", buffering=0) as raw_f, io.BufferedWriter(
+        raw_f, buffer_size=DUMP_BUFFER_SIZE
+    ) as json_f:
+        json_f.write(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
 def calc_stats(dataset, parameter="time_diff"):
-    total_diff = 0
-    data_points = []
-    for pkt in dataset:
-        if (pkt.get("seq_num", None) and pkt["seq_num"] != -1) or pkt.get(
-            "seq_num", None
-        ) is None:
-            total_diff += pkt[parameter]
-            data_points.append(pkt[parameter])
-
-    count = len(data_points)
-    std_deviation = statistics.stdev(data_points) if count > 1 else 0
-    max_point = max(data_points)
-    min_point = min(data_points)
-    median = statistics.median(data_points)
-    mean = total_diff / count
+    values = [
+        pkt[parameter]
+        for pkt in dataset
+        if (pkt.get("seq_num", None) and pkt["seq_num"] != -1)
+        or pkt.get("seq_num", None) is None
+    ]
+    return calc_array_stats(np.asarray(values))
 
+
+def calc_array_stats(values):
+    count = len(values)
     return {
         "count": count,
-        "min": min_point,
-        "max": max_point,
-        "mean": mean,
-        "std_dev": std_deviation,
-        "median": median,
+        "min": values.min().item(),
+        "max": values.max().item(),
+        "mean": float(values.mean()),
+        "std_dev": float(values.std(ddof=1)) if count > 1 else 0,
+        "median": float(np.median(values)),
     }
 
 
+@dataclass(slots=True)
+class RunningStats:
+    """Online count/min/max/mean/std_dev using Welford's algorithm and an approximate median
+    using the P-square algorithm (Jain & Chlamtac, 1985), so no samples need to be kept"""
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+    # P-square markers: heights (sorted first 5 samples until there are 5), actual and desired positions
+    heights: List[float] = field(default_factory=list)
+    positions: List[int] = field(default_factory=lambda: [0, 1, 2, 3, 4])
+    desired: List[float] = field(default_factory=lambda: [0.0, 1.0, 2.0, 3.0, 4.0])
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.update_median(value)
+
+    def update_median(self, value):
+        q = self.heights
+        if len(q) < 5:
+            bisect.insort(q, value)
+            return
+        n = self.positions
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = bisect.bisect_right(q, value) - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += P2_MEDIAN_INCREMENTS[i]
+
+        # Move middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                s = 1 if d > 0 else -1
+                height = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                q[i] = height
+                n[i] += s
+
+    def median(self):
+        if self.count < 5:
+            return float(np.median(self.heights))
+        return self.heights[2]
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "std_dev": math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0,
+            "median": self.median(),
+        }
+
+
 def get_time():
-    return time.time_ns() // (10 ** 3) / (10 ** 3)
+    # Wall clock time in ms (with us precision)
+    #   Not monotonic since publisher and subscriber timestamps are compared with each other
+    return time.time_ns() // NS_PER_US / US_PER_MS
 
 
 def connect_to_broker(client, userdata, properties=None):
+    # paho reconnects by itself with exponential backoff if the connection is lost unexpectedly
+    client.reconnect_delay_set(
+        min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY
+    )
     connected = False
-    userdata["conn_time"] = get_time()
+    backoff = RECONNECT_MIN_DELAY
+    userdata.conn_time = get_time()
     while not connected:
-        userdata["conn_tries"] += 1
+        userdata.conn_tries += 1
         try:
             client.connect(
                 hostname,
@@ -98,19 +262,21 @@ def connect_to_broker(client, userdata, properties=None):
             )
             connected = True
         except (socket.timeout, mqtt.WebsocketConnectionError):
-            print("connection error, retrying...")
+            print(f"connection error, retrying in {backoff}s...")
+            time.sleep(backoff)
+            backoff = min(RECONNECT_MAX_DELAY, backoff * 2)
 
 
 def record_connect(userdata):
-    if userdata["conn_time"] != -1 and userdata["conn_tries"] > 0:
+    if userdata.conn_time != -1 and userdata.conn_tries > 0:
         connected_time = get_time()
-        userdata["conn_data"].append(
+        userdata.conn_data.append(
             {
-                "connect_time": userdata["conn_time"],
+                "connect_time": userdata.conn_time,
                 "connected_time": connected_time,
-                "time_diff": connected_time - userdata["conn_time"],
-                "tries": userdata["conn_tries"],
+                "time_diff": connected_time - userdata.conn_time,
+                "tries": userdata.conn_tries,
             }
         )
-        userdata["conn_time"] = -1
-        userdata["conn_tries"] = 0
+        userdata.conn_time = -1
+        userdata.conn_tries = 0